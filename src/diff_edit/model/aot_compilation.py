@@ -0,0 +1,142 @@
+import hashlib
+import json
+import logging
+import os
+import re
+
+import torch
+import torch._inductor
+
+
+def model_identity(module):
+    """
+    This function builds a file name friendly identifier of a model, from the path or hub id it was loaded from and a
+    hash of its config, so that packages compiled for different models don't share a cache entry.
+
+    module (torch.nn.Module): The model, with a diffusers config.
+
+    return (str): The model identifier.
+    """
+    config = dict(getattr(module, "config", None) or {})
+    name = re.sub(r"[^A-Za-z0-9._-]+", "_", str(config.get("_name_or_path") or type(module).__name__)).strip("_")
+    config_hash = hashlib.sha1(json.dumps(config, sort_keys=True, default=str).encode()).hexdigest()[:12]
+    return f"{name}-{config_hash}"
+
+
+def to_package_layout(x):
+    """
+    This function puts an input in the memory layout the packages are compiled for: channels_last for 4D tensors,
+    the layout the rest of the pipeline already uses, and contiguous for the other tensors.
+
+    x: The input, non tensor inputs are returned as they are.
+
+    return: The input in the package layout.
+    """
+    if not isinstance(x, torch.Tensor):
+        return x
+    if x.dim() == 4:
+        return x.contiguous(memory_format=torch.channels_last)
+    return x.contiguous()
+
+
+class UNetTensorOutput(torch.nn.Module):
+    def __init__(self, unet):
+        """
+        This class wraps a UNet so that it returns the predicted noise as a plain tensor, which is what torch.export
+        expects as output.
+        """
+        super().__init__()
+        self.unet = unet
+
+    def forward(self, sample, timestep, encoder_hidden_states):
+        """
+        This method predicts the noise with the wrapped UNet.
+
+        sample (torch.Tensor): The noisy latents.
+        timestep (torch.Tensor): The diffusion timestep.
+        encoder_hidden_states (torch.Tensor): The text embeddings.
+
+        return (torch.Tensor): The predicted noise.
+        """
+        return self.unet(sample, timestep, encoder_hidden_states=encoder_hidden_states, return_dict=False)[0]
+
+
+class AOTModule(torch.nn.Module):
+    def __init__(self, runner, module, output_name=None):
+        """
+        This class wraps a model compiled ahead of time with AOTInductor, so that it can replace the original module.
+        The config and the dtype of the original module are kept, the weights are baked into the compiled package.
+
+        runner (Callable): The loaded AOTInductor package.
+        module (torch.nn.Module): The module that was compiled.
+        output_name (str): If provided, the output is returned in a dict under this key, e.g. "sample" for a UNet.
+        """
+        super().__init__()
+        self.runner = runner
+        self.config = getattr(module, "config", None)
+        self._dtype = next(module.parameters()).dtype
+        self.output_name = output_name
+
+    @property
+    def dtype(self):
+        """
+        The dtype of the compiled module parameters.
+        """
+        return self._dtype
+
+    def forward(self, *args, **kwargs):
+        """
+        This method runs the compiled package, with the same inputs as the original module.
+
+        return: The output of the compiled package, in a dict under output_name if it was provided.
+        """
+        # the package was compiled for these layouts, for inputs already in them this is a no-op
+        args = [to_package_layout(arg) for arg in args]
+        kwargs = {k: to_package_layout(v) for k, v in kwargs.items()}
+        out = self.runner(*args, **kwargs)
+        return {self.output_name: out} if self.output_name is not None else out
+
+
+class AOTCompiler:
+    def __init__(self, cache_dir):
+        """
+        This class compiles modules ahead of time with torch.export and AOTInductor, storing the compiled packages in
+        a cache directory. Later processes load the packages instead of compiling again.
+
+        cache_dir (str): The directory to store the compiled packages in. Delete it when model weights are replaced
+            in place, the package names only identify the model path and config.
+        """
+        self.cache_dir = cache_dir
+
+    @staticmethod
+    def is_available():
+        """
+        This method checks whether the installed PyTorch supports AOTInductor packages (PyTorch 2.6 or newer).
+        """
+        return hasattr(torch._inductor, "aoti_compile_and_package") and hasattr(torch._inductor, "aoti_load_package")
+
+    def load_or_compile(self, name, module, example_args, example_kwargs=None):
+        """
+        This method loads the compiled package for a module from the cache directory, compiling and storing it first
+        if it is not there.
+
+        name (str): The name of the package, it must identify everything the compiled graph depends on: the model
+            (see model_identity), the input shapes, the dtype, the device and the quantization.
+        module (torch.nn.Module): The module to compile.
+        example_args (tuple): Example positional inputs, the compiled package is specialized on their shapes. They
+            are put in the package layout (see to_package_layout).
+        example_kwargs (dict): Example keyword inputs. The package must be called with the same keywords. Optional.
+
+        return (Callable): The loaded package, to be called like the module.
+        """
+        package_path = os.path.join(self.cache_dir, f"{name}.pt2")
+        if not os.path.exists(package_path):
+            logging.info(f"Compiling {name} ahead of time, the package is stored in {package_path}")
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with torch.no_grad():
+                example_kwargs = {k: to_package_layout(v) for k, v in (example_kwargs or {}).items()}
+                exported = torch.export.export(module, tuple(to_package_layout(arg) for arg in example_args),
+                                               kwargs=example_kwargs)
+                torch._inductor.aoti_compile_and_package(exported, package_path=package_path)
+        logging.debug(f"Loading the compiled package {package_path}")
+        return torch._inductor.aoti_load_package(package_path)
@@ -1,11 +1,13 @@
 # Standard library imports
 import logging
 import os
-import pickle
-from typing import Union
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Callable, Union
 
 # Related third-party imports
 import torch
+import torch._inductor.config
 from PIL import Image
 from diffusers import (
     AutoencoderKL,
@@ -13,15 +15,36 @@ from diffusers import (
     LMSDiscreteScheduler,
     StableDiffusionInpaintPipeline,
 )
+from diffusers.models.attention_processor import AttnProcessor2_0
+
+try:
+    from diffusers.models.attention_processor import FusedAttnProcessor2_0
+except ImportError:  # older diffusers versions can't fuse the projections
+    FusedAttnProcessor2_0 = None
 from transformers import CLIPTextModel, CLIPTokenizer
 
 # local application/library specific imports
+from diff_edit.model.aot_compilation import AOTCompiler, AOTModule, UNetTensorOutput, model_identity
 from diff_edit.model.constants import VAE_CONST, TORCH_SEED, IMG_RESIZE_DIM
 from diff_edit.model.image_processing import ImageProcessor
 from diff_edit.model.mask_generation import MaskGenerator
 from diff_edit.model.mask_inpainting import Inpainter
 
-torch.manual_seed(TORCH_SEED)
+
+@lru_cache(maxsize=8)
+def _load_resized(path: str, mtime: float, size: int) -> Image.Image:
+    """
+    This function loads an image from disk and resizes it to a square of the given size. Results are cached, the
+    modification time is part of the key so that edited files are loaded again.
+
+    path (str): The path to the image.
+    mtime (float): The modification time of the image file.
+    size (int): The size of the resized image side.
+
+    return (Image.Image): The resized image. It's shared by the cache, don't modify it in place.
+    """
+    with Image.open(path) as im:
+        return im.resize((size, size))
 
 
 class DiffEdit:
@@ -32,11 +55,37 @@ class DiffEdit:
                  inpainting: StableDiffusionInpaintPipeline = None,
                  scheduler: LMSDiscreteScheduler = None,
                  torch_device: str = None,
+                 dtype: torch.dtype = None,
+                 compile: bool = True,
+                 quantize: str = None,
+                 low_vram: bool = False,
+                 cache_dir: str = None,
+                 text_encoder_8bit: bool = False,
+                 inpainting_loader: Callable[[], StableDiffusionInpaintPipeline] = None,
                  ):
         """
         This class represents the DiffEdit model. It is a wrapper around the components of the model, such as the
         VAE, the UNet, the tokenizer and the text encoder. It provides methods to generate masks, inpaint images and
         perform the DiffEdit algorithm.
+
+        dtype (torch.dtype): The dtype to cast the components to. Optional, default is torch.bfloat16 on "cuda",
+         torch.float16 on "mps" (older PyTorch versions don't support bfloat16 there), torch.float32 otherwise.
+        compile (bool): Whether to torch.compile the UNet, the VAE and the text encoder when running on "cuda". The
+         first call pays the compilation cost, so this is worth it only when the instance is reused. Default is True.
+        quantize (str): Dynamic quantization of the UNets linear layers with torchao, applied on "cuda" only. Valid
+         values are "int8", "fp8" (H100 or newer) and None. Optional, default is None (no quantization).
+        low_vram (bool): Whether to keep the text encoder on the CPU, moving it to the device only to compute the
+         prompt embeddings, and to use tiled VAE encoding/decoding. Frees memory for the UNet. Optional, default is
+         False.
+        cache_dir (str): If provided, when compiling on "cuda" the UNet and the VAE decoder (not in low VRAM mode) are
+         compiled ahead of time with AOTInductor and stored in this directory, so later processes load them instead of
+         compiling again.
+         Requires PyTorch 2.6 or newer. Delete the directory when the models change. Optional, default is None.
+        text_encoder_8bit (bool): Whether to replace the text encoder linear layers with bitsandbytes 8-bit ones,
+         halving their memory. Applied on "cuda" only. The 8-bit text encoder is never offloaded in low VRAM mode.
+         Optional, default is False.
+        inpainting_loader (Callable): A function returning the inpainting pipeline, used instead of inpainting to
+         load it lazily on first use. Useful when only the masks are needed. Optional, default is None.
         """
         # attributes for the components
         self.tokenizer: Union[CLIPTokenizer, None] = tokenizer
@@ -44,20 +93,71 @@ class DiffEdit:
 
         self.vae: Union[AutoencoderKL, None] = vae
         self.unet: Union[UNet2DConditionModel, None] = unet
-        self.inpainting: Union[StableDiffusionInpaintPipeline, None] = inpainting
+        # the inpainting pipeline is loaded on first access when a loader is provided, see the inpainting property
+        self._inpainting: Union[StableDiffusionInpaintPipeline, None] = inpainting
+        self._inpainting_loader: Union[Callable[[], StableDiffusionInpaintPipeline], None] = inpainting_loader
+        self._inpainter: Union[Inpainter, None] = None
 
         self.scheduler: Union[LMSDiscreteScheduler, None] = scheduler
 
         # attributes for the device
         self.torch_device: Union[str, None] = torch_device
-        logging.debug(f"Setting the device to {torch_device}")
+        if dtype is None:
+            dtype = {"cuda": torch.bfloat16, "mps": torch.float16}.get(torch_device, torch.float32)
+        self.dtype: torch.dtype = dtype
+        # let cuDNN pick the fastest convolution algorithms and allow TF32 matmuls on Ampere and newer
+        torch.backends.cudnn.benchmark = True
+        torch.backends.cuda.matmul.allow_tf32 = True
+        self.compile: bool = compile
+        if quantize not in (None, "int8", "fp8"):
+            raise ValueError(f"Invalid quantization, please use int8, fp8 or None. Received: {quantize} instead.")
+        self.quantize: Union[str, None] = quantize
+        self._quantized: bool = False
+        self._inpainting_quantized: bool = False
+        self.low_vram: bool = low_vram
+        self.text_encoder_8bit: bool = text_encoder_8bit
+        self._text_encoder_quantized: bool = False
+        self.cache_dir: Union[str, None] = cache_dir
+        # text embeddings of the prompts seen so far, valid for the current device and dtype
+        self._emb_cache: dict[str, torch.Tensor] = {}
+        # ((path, mtime, seed), image, latent) of the last image encoded from disk, see _load_and_encode
+        self._last_encoded: Union[tuple, None] = None
+        self._warmed_up: bool = False
+        logging.debug(f"Setting the device to {torch_device} ({dtype})")
         self.to(torch_device)
         logging.debug(f"Device set to {torch_device}")
 
-        self.image_processor = ImageProcessor(vae, torch_device)
-        self.mask_generator = MaskGenerator(unet, scheduler, tokenizer, text_encoder, self.image_processor,
-                                            torch_device)
-        self.inpainter = Inpainter(inpainting, torch_device)
+        self.image_processor = ImageProcessor(self.vae, torch_device)
+        self.mask_generator = MaskGenerator(self.unet, scheduler, tokenizer, self.text_encoder, self.image_processor,
+                                            torch_device, embedding_provider=self._get_embeddings_for_prompts)
+
+    @property
+    def inpainting(self) -> Union[StableDiffusionInpaintPipeline, None]:
+        """
+        The inpainting pipeline. When an inpainting loader was provided, the pipeline is loaded, moved to the device
+        and optimized on first access.
+        """
+        if self._inpainting is None and self._inpainting_loader is not None:
+            logging.debug("Loading the inpainting pipeline")
+            # first access usually happens under inference mode, the weights must not become inference tensors
+            with torch.inference_mode(False):
+                self._inpainting = self._inpainting_loader()
+                self._prepare_inpainting(self.torch_device)
+        return self._inpainting
+
+    @inpainting.setter
+    def inpainting(self, inpainting: Union[StableDiffusionInpaintPipeline, None]):
+        self._inpainting = inpainting
+        self._inpainter = None
+
+    @property
+    def inpainter(self) -> Inpainter:
+        """
+        The inpainter, created on first access together with the inpainting pipeline.
+        """
+        if self._inpainter is None:
+            self._inpainter = Inpainter(self.inpainting, self.torch_device)
+        return self._inpainter
 
     def to(self, device: str):
         """
@@ -66,18 +166,306 @@ class DiffEdit:
 
              return (DiffEdit): The DiffEdit model with the components moved to the specified device.
          """
-        # move the components to the device
-        self.vae = self.vae.to(device)
-        self.text_encoder = self.text_encoder.to(device)
-        self.unet = self.unet.to(device)
-        self.inpainting = self.inpainting.to(device)
+        # embeddings computed on another device are stale
+        if device != self.torch_device:
+            self._emb_cache.clear()
+            self._last_encoded = None
+            self._inpainter = None
+        self.torch_device = device
+
+        # the 8-bit weights are quantized when moved to the device, so the layers must be replaced before
+        if self.text_encoder_8bit and not self._text_encoder_quantized:
+            if device == "cuda":
+                self._text_encoder_to_8bit()
+            else:
+                logging.warning(f"8-bit text encoder is only supported on cuda, skipping it on {device}.")
+
+        # move the components to the device, casting them to the model dtype
+        self.vae = self.vae.to(device=device, dtype=self.dtype)
+        # in low VRAM mode the text encoder lives on the CPU, see _get_embeddings_for_prompts
+        self.text_encoder = self.text_encoder.to(device="cpu" if self._offload_text_encoder else device,
+                                                 dtype=self.dtype)
+        self.unet = self.unet.to(device=device, dtype=self.dtype)
+
+        # the UNets and the VAEs are convolution heavy, NHWC kernels are faster than NCHW ones
+        self.unet = self.unet.to(memory_format=torch.channels_last)
+        self.vae = self.vae.to(memory_format=torch.channels_last)
+
+        # encode/decode batches one sample at a time, to bound the VAE peak memory. Tiling also splits each image,
+        # it changes the result slightly, so it is used only in low VRAM mode
+        self.vae.enable_slicing()
+        if self.low_vram:
+            self.vae.enable_tiling()
+
+        # attention through F.scaled_dot_product_attention (FlashAttention when available). It must happen before
+        # fusing the projections, which then switches to the fused variant of this processor
+        self._set_sdpa_attention(self.unet)
+
+        # one larger q,k,v matmul instead of three small ones. It must happen before compiling
+        self._fuse_qkv_projections(self.unet)
+        self._fuse_qkv_projections(self.vae)
+
+        if self.quantize is not None and not self._quantized:
+            if device == "cuda":
+                self._quantize_unet(self.unet)
+                self._quantized = True
+            else:
+                logging.warning(f"Quantization is only supported on cuda, skipping it on {device}.")
+
+        if device == "cuda" and self.compile:
+            logging.debug("Compiling the UNet, the VAE and the text encoder")
+            torch._inductor.config.conv_1x1_as_mm = True
+            torch._inductor.config.coordinate_descent_tuning = True
+
+            if self.cache_dir is not None:
+                if AOTCompiler.is_available():
+                    self._aot_compile()
+                else:
+                    logging.warning("AOTInductor packages require PyTorch 2.6 or newer, falling back to torch.compile")
+
+            self.unet = self._compile(self.unet)
+            self.vae.encoder = self._compile(self.vae.encoder)
+            self.vae.decoder = self._compile(self.vae.decoder)
+            # moving a compiled module back and forth would defeat CUDAGraphs, bitsandbytes layers don't compile well
+            if not self.low_vram and not self._text_encoder_quantized:
+                self.text_encoder = self._compile(self.text_encoder)
+
+            # the mask generator keeps its own references, point it to the compiled components
+            if hasattr(self, "mask_generator"):
+                self.mask_generator.unet = self.unet
+                self.mask_generator.text_encoder = self.text_encoder
+
+        # a lazily loaded inpainting pipeline is prepared when first accessed
+        if self._inpainting is not None:
+            self._prepare_inpainting(device)
         return self
 
-    def get_mask(self, im_path: str, p1: str, p2: str, seed: int = TORCH_SEED, n: int = 10):
+    def _prepare_inpainting(self, device: str):
+        """
+        This method moves the inpainting pipeline to the specified device and applies to it the same optimizations
+        as to() does for the mask generation components.
+
+        device (str): The device to move the pipeline to. Valid values are "cpu", "mps" and "cuda".
+        """
+        self._inpainting = self._inpainting.to(device=device, dtype=self.dtype)
+
+        self._inpainting.unet.to(memory_format=torch.channels_last)
+        self._inpainting.vae.to(memory_format=torch.channels_last)
+
+        self._inpainting.vae.enable_slicing()
+        if self.low_vram:
+            self._inpainting.vae.enable_tiling()
+
+        self._set_sdpa_attention(self._inpainting.unet)
+        self._fuse_qkv_projections(self._inpainting.unet)
+
+        if device == "cuda":
+            if self.quantize is not None and not self._inpainting_quantized:
+                self._quantize_unet(self._inpainting.unet)
+                self._inpainting_quantized = True
+            if self.compile:
+                self._inpainting.unet = self._compile(self._inpainting.unet)
+
+    @property
+    def _offload_text_encoder(self) -> bool:
+        """
+        Whether the text encoder lives on the CPU between calls. True in low VRAM mode, unless the text encoder was
+        quantized to 8-bit: its weights can't be moved back to the CPU.
+        """
+        return self.low_vram and not self._text_encoder_quantized
+
+    def _text_encoder_to_8bit(self):
+        """
+        This method replaces each linear layer of the text encoder with a bitsandbytes 8-bit one, copying the weights.
+        The weights are quantized when the text encoder is moved to the cuda device.
+        """
+        try:
+            import bitsandbytes as bnb
+        except ImportError as e:
+            raise ImportError("bitsandbytes is required for the 8-bit text encoder, install it with "
+                              "`pip install bitsandbytes`") from e
+
+        logging.debug("Replacing the text encoder linear layers with 8-bit ones")
+        linears = [(parent, name, child) for parent in self.text_encoder.modules()
+                   for name, child in parent.named_children() if isinstance(child, torch.nn.Linear)]
+        for parent, name, linear in linears:
+            linear_8bit = bnb.nn.Linear8bitLt(linear.in_features, linear.out_features, bias=linear.bias is not None,
+                                              has_fp16_weights=False, threshold=6.0)
+            linear_8bit.weight = bnb.nn.Int8Params(linear.weight.data.cpu(), requires_grad=False,
+                                                   has_fp16_weights=False)
+            if linear.bias is not None:
+                linear_8bit.bias = torch.nn.Parameter(linear.bias.data.cpu(), requires_grad=False)
+            setattr(parent, name, linear_8bit)
+        self._text_encoder_quantized = True
+
+    @staticmethod
+    def _set_sdpa_attention(unet: UNet2DConditionModel):
+        """
+        This method sets the attention processors of a UNet to AttnProcessor2_0, which relies on PyTorch scaled dot
+        product attention. UNets whose projections were already fused are left untouched, so that they keep the
+        FusedAttnProcessor2_0 set by _fuse_qkv_projections.
+
+        unet (UNet2DConditionModel): The UNet to set the attention processors of.
+        """
+        if hasattr(unet, "set_attn_processor") and getattr(unet, "original_attn_processors", None) is None:
+            unet.set_attn_processor(AttnProcessor2_0())
+
+    @staticmethod
+    def _fuse_qkv_projections(model: torch.nn.Module):
+        """
+        This method fuses the query, key and value projections of the attention layers of a diffusers model, if the
+        model supports it and they are not fused already. Fusing only builds the fused weights, the model is then
+        switched to FusedAttnProcessor2_0 so that the attention actually uses them.
+
+        model (torch.nn.Module): The model to fuse the projections of.
+        """
+        if FusedAttnProcessor2_0 is None or not hasattr(model, "fuse_qkv_projections"):
+            return
+        if getattr(model, "original_attn_processors", None) is None:
+            model.fuse_qkv_projections()
+            model.set_attn_processor(FusedAttnProcessor2_0())
+
+    def _quantize_unet(self, unet: UNet2DConditionModel):
+        """
+        This method quantizes the linear layers of a UNet with torchao, using dynamic activation and weight
+        quantization. It must happen after fusing the projections and before compiling.
+
+        unet (UNet2DConditionModel): The UNet to quantize.
+        """
+        try:
+            from torchao.quantization import (
+                float8_dynamic_activation_float8_weight,
+                int8_dynamic_activation_int8_weight,
+                quantize_,
+            )
+        except ImportError as e:
+            raise ImportError("torchao is required for quantization, install it with `pip install torchao`") from e
+
+        logging.debug(f"Quantizing the UNet to {self.quantize}")
+        if self.quantize == "int8":
+            quantize_(unet, int8_dynamic_activation_int8_weight())
+        else:
+            quantize_(unet, float8_dynamic_activation_float8_weight())
+
+    @staticmethod
+    def _compile(module: torch.nn.Module):
+        """
+        This method compiles a module with torch.compile, unless it was already compiled by a previous call to to()
+        or ahead of time.
+
+        module (torch.nn.Module): The module to compile.
+
+        return (torch.nn.Module): The compiled module.
+        """
+        if hasattr(module, "_orig_mod") or isinstance(module, AOTModule):
+            return module
+        return torch.compile(module, mode="reduce-overhead", fullgraph=False)
+
+    def _aot_compile(self):
+        """
+        This method replaces the UNet and the VAE decoder with their AOTInductor compiled packages, loading them from
+        the cache directory or compiling and storing them there on the first run. The VAE decoder is compiled for
+        whole latents, so it's skipped in low VRAM mode where tiling feeds it smaller tiles.
+        """
+        compiler = AOTCompiler(self.cache_dir)
+        # the package names identify everything that changes the compiled graphs: the model, the input size, the
+        # dtype, the device and the quantization
+        suffix = (f"{IMG_RESIZE_DIM}px-{self.torch_device}-{str(self.dtype).replace('torch.', '')}-"
+                  f"{self.quantize or 'noquant'}")
+        if not isinstance(self.unet, AOTModule):
+            latents, timestep, embeddings = self._example_unet_inputs()
+            runner = compiler.load_or_compile(f"unet-{model_identity(self.unet)}-{suffix}", UNetTensorOutput(self.unet),
+                                              (latents, timestep), {"encoder_hidden_states": embeddings})
+            self.unet = AOTModule(runner, self.unet, output_name="sample")
+        if not isinstance(self.vae.decoder, AOTModule) and not self.low_vram:
+            latent_dim = IMG_RESIZE_DIM // 8  # the VAE downsamples by a factor of 8
+            latents = torch.zeros(1, self.vae.config.latent_channels, latent_dim, latent_dim, device=self.torch_device,
+                                  dtype=self.dtype).contiguous(memory_format=torch.channels_last)
+            runner = compiler.load_or_compile(f"vae_decoder-{model_identity(self.vae)}-{suffix}", self.vae.decoder,
+                                              (latents,))
+            self.vae.decoder = AOTModule(runner, self.vae.decoder)
+
+    def _example_unet_inputs(self):
+        """
+        This method builds dummy UNet inputs with the shapes used by the mask generation: a batch of two latents (the
+        unconditional and the conditional one), a timestep and the text embeddings.
+
+        return (tuple): The latents, the timestep and the text embeddings.
+        """
+        latent_dim = IMG_RESIZE_DIM // 8  # the VAE downsamples by a factor of 8
+        latents = torch.zeros(2, self.unet.config.in_channels, latent_dim, latent_dim, device=self.torch_device,
+                              dtype=self.dtype).contiguous(memory_format=torch.channels_last)
+        timestep = torch.tensor(1., device=self.torch_device)
+        embeddings = torch.zeros(2, self.tokenizer.model_max_length, self.unet.config.cross_attention_dim,
+                                 device=self.torch_device, dtype=self.dtype)
+        return latents, timestep, embeddings
+
+    def _warmup(self):
+        """
+        This method runs the UNet once on dummy inputs, so the torch.compile compilation and the CUDA graphs capture
+        happen before the actual inputs are ready. It does nothing if the UNet is not compiled or already warmed up.
+        """
+        if self._warmed_up or not (self.torch_device == "cuda" and self.compile):
+            return
+        logging.debug("Warming up the UNet")
+        latents, timestep, embeddings = self._example_unet_inputs()
+        self.unet(latents, timestep, encoder_hidden_states=embeddings)
+        torch.cuda.synchronize()
+        self._warmed_up = True
+
+    def _load_image(self, im_path: Union[str, Image.Image]) -> Image.Image:
+        """
+        This method loads an image and resizes it to the model input size.
+
+        im_path (Union[str, Image.Image]): The path to the image, or the image itself.
+
+        return (Image.Image): The resized image.
+        """
+        if isinstance(im_path, Image.Image):
+            return im_path if im_path.size == (IMG_RESIZE_DIM, IMG_RESIZE_DIM) else \
+                im_path.resize((IMG_RESIZE_DIM, IMG_RESIZE_DIM))
+        if not os.path.exists(im_path):
+            raise ValueError(f"Image path {im_path} does not exist. Check the provided path")
+        return _load_resized(im_path, os.path.getmtime(im_path), IMG_RESIZE_DIM).copy()
+
+    def _load_and_encode(self, im_path: Union[str, Image.Image, torch.Tensor], seed: int = TORCH_SEED):
+        """
+        This method loads an image and encodes it into the VAE latent space. The last image loaded from disk is
+        memoised on its path, modification time and seed, so encoding it again is free. A tensor is taken as an
+        already encoded latent, and it's decoded to get the image back.
+
+        im_path (Union[str, Image.Image, torch.Tensor]): The path to the image, the image itself or its latent.
+        seed (int): The seed used to sample the latent distribution.
+
+        return (tuple): A tuple containing the resized image and its latent.
+        """
+        if isinstance(im_path, torch.Tensor):
+            im_latent = im_path.to(self.torch_device, dtype=self.dtype)
+            im = self.image_processor.latents2imgs(im_latent, VAE_CONST)[0]
+        else:
+            key = None
+            if isinstance(im_path, str) and os.path.exists(im_path):
+                key = (im_path, os.path.getmtime(im_path), seed)
+                if self._last_encoded is not None and self._last_encoded[0] == key:
+                    return self._last_encoded[1], self._last_encoded[2]
+
+            im = self._load_image(im_path)
+            generator = torch.Generator(device=self.torch_device).manual_seed(seed)
+            im_latent = self.image_processor.img2latent(im, VAE_CONST, generator=generator).to(self.dtype)
+            im_latent = im_latent.contiguous(memory_format=torch.channels_last)
+            if key is not None:
+                self._last_encoded = (key, im, im_latent)
+            return im, im_latent
+        return im, im_latent.contiguous(memory_format=torch.channels_last)
+
+    @torch.inference_mode()
+    def get_mask(self, im_path: Union[str, Image.Image, torch.Tensor], p1: str, p2: str, seed: int = TORCH_SEED,
+                 n: int = 10):
         """
             This method returns the mask generated by the DiffEdit algorithm.
 
-            im_path (str): The path to the image to edit.
+            im_path (Union[str, Image.Image, torch.Tensor]): The path to the image to edit, the image itself or its
+             latent.
             p1 (str): The prompt to remove.
             p2 (str): The prompt to add.
             n (int): The number of iterations to perform to get the mask. Each iteration is a diffusion process.
@@ -85,9 +473,7 @@ class DiffEdit:
 
             return (list): A list containing the processed mask, the rough mask, the blended mask (visualization only)
         """
-        with Image.open(im_path) as im:
-            im = im.resize((IMG_RESIZE_DIM, IMG_RESIZE_DIM))
-            im_latent = self.image_processor.img2latent(im, VAE_CONST)
+        im, im_latent = self._load_and_encode(im_path, seed)
 
         mask = self.mask_generator.calc_diffedit_mask(im_latent, p1, p2, n, seed)
         return self.mask_generator.processed_mask, self.mask_generator.rough_mask, \
@@ -107,11 +493,13 @@ class DiffEdit:
         """
         pass
 
-    def create_mask(self, im_path: str, p1: str, p2: str, n: int = 10, seed: int = TORCH_SEED):
+    def create_mask(self, im_path: Union[str, Image.Image, torch.Tensor], p1: str, p2: str, n: int = 10,
+                    seed: int = TORCH_SEED):
         """
             This method creates a mask for the specified image using the DiffEdit algorithm.
 
-            im_path (str): The path to the image to edit.
+            im_path (Union[str, Image.Image, torch.Tensor]): The path to the image to edit, the image itself or its
+             latent.
             p1 (str): The prompt to remove.
             p2 (str): The prompt to add.
             n (int): The number of iterations to perform to get the mask. Each iteration is a diffusion process.
@@ -120,7 +508,7 @@ class DiffEdit:
             return (Image): The mask generated by the DiffEdit algorithm.
         """
 
-        if not os.path.exists(im_path):
+        if isinstance(im_path, str) and not os.path.exists(im_path):
             raise ValueError(f"Image path {im_path} does not exist. Check the provided path")
 
         logging.info(f"Obtaining the mask by running the diffusion process {n} times.")
@@ -128,25 +516,22 @@ class DiffEdit:
 
         return mask, rough_mask, blended_mask
 
-    def save_mask(self, mask: Image, rough_mask: Image, blended_mask: Image, im_path: str, workdir: str = "./"):
+    def save_mask(self, mask: Image, rough_mask: Image, blended_mask: Image, im_path: Union[str, Image.Image],
+                  workdir: str = "./"):
         """
         This method saves the mask and the image to disk.
 
         mask (Image): The mask to save.
         rough_mask (Image): The rough mask to save.
         blended_mask (Image): The blended mask to save.
-        im_path (str): The path to the image to save.
+        im_path (Union[str, Image.Image]): The path to the image to save, or the image itself.
         workdir (str): The directory to save the mask. Optional, default is "./".
         """
-        # save the mask to disk
-        with open(os.path.join(workdir, "mask.bmp"), "wb") as f:
-            mask.save(f)
-        with open(os.path.join(workdir, "rough_mask.bmp"), "wb") as f:
-            rough_mask.save(f)
-        with open(os.path.join(workdir, "blended_mask.bmp"), "wb") as f:
-            blended_mask.save(f)
-        with open(os.path.join(workdir, "original_image.bmp"), "wb") as f:
-            Image.open(im_path).resize((IMG_RESIZE_DIM, IMG_RESIZE_DIM)).save(f)
+        # save the mask to disk. The mask is binary, so it's stored with 1 bit per pixel
+        mask.convert("1").save(os.path.join(workdir, "mask.png"))
+        rough_mask.save(os.path.join(workdir, "rough_mask.png"))
+        blended_mask.save(os.path.join(workdir, "blended_mask.png"))
+        self._load_image(im_path).save(os.path.join(workdir, "original_image.png"))
 
     def save_inpainted_image(self, inpainted_image: Image, workdir: str = "./"):
         """
@@ -156,48 +541,49 @@ class DiffEdit:
         workdir (str): The directory to save the inpainted image. Optional, default is "./".
         """
         # save the inpainted image to disk
-        with open(os.path.join(workdir, "inpainted_image.bmp"), "wb") as f:
-            inpainted_image.save(f)
+        inpainted_image.save(os.path.join(workdir, "inpainted_image.png"))
 
 
     def load_mask(self, workdir: str = "./"):
         # Load the mask from disk
-        mask_path = os.path.join(workdir, "mask.bmp")
-        rough_mask_path = os.path.join(workdir, "rough_mask.bmp")
-        blended_mask_path = os.path.join(workdir, "blended_mask.bmp")
-
-        if not all([os.path.exists(mask_path), os.path.exists(rough_mask_path), os.path.exists(blended_mask_path),]):
+        mask_path = os.path.join(workdir, "mask.png")
+        rough_mask_path = os.path.join(workdir, "rough_mask.png")
+        blended_mask_path = os.path.join(workdir, "blended_mask.png")
+
+        # a single directory listing instead of one stat per file
+        try:
+            with os.scandir(workdir) as entries:
+                present = {entry.name for entry in entries}
+        except FileNotFoundError:
+            present = set()
+        if not {"mask.png", "rough_mask.png", "blended_mask.png"}.issubset(present):
             raise ValueError(f"Mask files not found in {workdir}. Run create_mask to generate the mask.")
-        with open(mask_path, "rb") as f:
-            mask = Image.open(f).copy()
-        with open(rough_mask_path, "rb") as f:
-            rough_mask = Image.open(f).copy()
-        with open(blended_mask_path, "rb") as f:
-            blended_mask = Image.open(f).copy()
+        mask = Image.open(mask_path).copy()
+        rough_mask = Image.open(rough_mask_path).copy()
+        blended_mask = Image.open(blended_mask_path).copy()
 
         return mask, rough_mask, blended_mask
 
-    def inpaint_mask_with_prompt(self, im_path: str, mask: Image, p2: str, seed: int = TORCH_SEED):
+    @torch.inference_mode()
+    def inpaint_mask_with_prompt(self, im_path: Union[str, Image.Image], mask: Image, p2: str, seed: int = TORCH_SEED):
         """
             This method inpaints the image using the mask generated by the DiffEdit algorithm. The mask is loaded from
             disk.
 
-            im_path (str): The path to the image to edit.
+            im_path (Union[str, Image.Image]): The path to the image to edit, or the image itself.
             p2 (str): The prompt to add.
             workdir (str): The directory to load the masks from. Optional, default is "./".
             seed (int): The seed to use for reproducibility.
         """
-        if not os.path.exists(im_path):
-            raise ValueError(f"Image path {im_path} does not exist. Check the provided path")
-
-        im = Image.open(im_path).resize((IMG_RESIZE_DIM, IMG_RESIZE_DIM)).copy()
+        im = self._load_image(im_path)
 
         logging.info(f"Inpainting the image using the mask.")
         inpainted_image = self.inpainter.inpaint_mask(im, mask, p2, seed)
 
         return inpainted_image
 
-    def demo_diffedit(self, im_path: str, p1: str, p2: str, n: int = 10, seed: int = TORCH_SEED):
+    @torch.inference_mode()
+    def demo_diffedit(self, im_path: str, p1: str, p2: str, n: int = 10, seed: int = TORCH_SEED, save: bool = True):
         """
         This method performs the DiffEdit algorithm on the specified image.
         im_path (str): The path to the image to edit.
@@ -205,6 +591,8 @@ class DiffEdit:
         p2 (str): The prompt to add.
         n (int): The number of iterations to perform to get the mask. Each iteration is a diffusion process.
         seed (int): The seed to use for reproducibility.
+        save (bool): Whether to save the masks and the inpainted image to disk, in the current directory. Optional,
+         default is True.
 
         return (list): A list containing the original image, the original image with mask and the resulting inpainted
          image.
@@ -213,34 +601,66 @@ class DiffEdit:
             raise ValueError(f"Image path {im_path} does not exist. Check the provided path")
         out = []
 
-        # getting image latent to put them in the output
-        im = Image.open(im_path).resize((IMG_RESIZE_DIM, IMG_RESIZE_DIM)).copy()
+        # the image is loaded once and shared by the mask generation, the inpainting and the output. Decoding it in
+        # background hides its latency behind the UNet warmup
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            future = executor.submit(self._load_image, im_path)
+            self._warmup()
+            im = future.result()
         out.append(im)
 
         logging.info(f"Obtaining the mask by running the diffusion process {n} times.")
-        mask, rough_mask, blended_mask = self.create_mask(im_path, p1, p2, n, seed=seed)
-        self.save_mask(mask, rough_mask, blended_mask, im_path)
+        mask, rough_mask, blended_mask = self.create_mask(im, p1, p2, n, seed=seed)
+        if save:
+            self.save_mask(mask, rough_mask, blended_mask, im)
 
         out.append(blended_mask)  # blended mask is the visualization of the mask on the image with some transparency
 
-        # load mask from disk
-        mask, rough_mask, blended_mask = self.load_mask(workdir="./")
         logging.info(f"Inpainting the image using the mask.")
-        inpainted_image = self.inpaint_mask_with_prompt(im_path, mask, p2, seed=seed)
-        self.save_inpainted_image(inpainted_image)
+        inpainted_image = self.inpaint_mask_with_prompt(im, mask, p2, seed=seed)
+        if save:
+            self.save_inpainted_image(inpainted_image)
         out.append(inpainted_image)
         return out
 
     def _get_embedding_for_prompt(self, prompt):
         """
-        This method gets the embedding for a prompt using the text encoder.
+        This method gets the embedding for a prompt using the text encoder. Embeddings are cached by prompt, so
+        repeated calls with the same prompt don't run the text encoder again.
 
         prompt (str): The prompt to get the embedding for.
 
         return (torch.Tensor): The embedding for the prompt.
         """
-        max_length = self.tokenizer.model_max_length
-        tokens = self.tokenizer([prompt], padding="max_length", max_length=max_length, truncation=True,
-                                return_tensors="pt")
-        with torch.no_grad():  # we are using for inference, no gradients needed
-            return self.text_encoder(tokens.input_ids.to(self.torch_device))[0]
+        return self._get_embeddings_for_prompts([prompt])
+
+    def _get_embeddings_for_prompts(self, prompts: list[str]) -> torch.Tensor:
+        """
+        This method gets the embeddings for a list of prompts. The prompts missing from the cache are encoded
+        together, with a single forward pass of the text encoder.
+
+        prompts (list[str]): The prompts to get the embeddings for.
+
+        return (torch.Tensor): The embeddings for the prompts, with shape (len(prompts), L, D).
+        """
+        missing = [prompt for prompt in dict.fromkeys(prompts) if prompt not in self._emb_cache]
+        if missing:
+            max_length = self.tokenizer.model_max_length
+            tokens = self.tokenizer(missing, padding="max_length", max_length=max_length, truncation=True,
+                                    return_tensors="pt")
+            # autocast is only available on cuda and a no-op for float32
+            autocast_enabled = self.torch_device == "cuda" and self.dtype != torch.float32
+            if self._offload_text_encoder:
+                self.text_encoder.to(self.torch_device)
+            try:
+                with torch.inference_mode():  # we are using for inference, no gradients nor version counters needed
+                    with torch.autocast(device_type="cuda", dtype=self.dtype, enabled=autocast_enabled):
+                        embeddings = self.text_encoder(tokens.input_ids.to(self.torch_device))[0]
+            finally:
+                if self._offload_text_encoder:
+                    self.text_encoder.to("cpu")
+            # the encoder output may live in a CUDA graph buffer that later runs overwrite, the cache needs its own copy
+            for i, prompt in enumerate(missing):
+                self._emb_cache[prompt] = embeddings[i:i + 1].clone()
+
+        return torch.cat([self._emb_cache[prompt] for prompt in prompts])
@@ -9,21 +9,27 @@ class ImageProcessor:
         self.vae = vae
         self.torch_device = torch_device
 
-    def img2latent(self, im, vae_magic_number):
+    def img2latent(self, im, vae_magic_number, generator=None):
         """
         This method converts an image to a latent representation using the VAE.
 
         im (PIL.Image): The image to convert to a latent representation.
         vae_magic_number (float): The magic number to scale the latent representation by.
+        generator (torch.Generator): The generator used to sample the latent distribution. Optional.
 
         return (torch.Tensor): The latent representation of the image.
         """
         # convert image to tensor
         im = transforms.ToTensor()(im).unsqueeze(0)
+        if self.torch_device == "cuda":
+            # pinned memory allows an asynchronous host to device copy
+            im = im.pin_memory()
+        # copy first, then cast on the device: casting during the copy would go through an unpinned CPU temporary
+        im = im.to(self.torch_device, non_blocking=True).to(self.vae.dtype)
         with torch.no_grad():
             # encode the image into latent space through the VAE
-            latent = self.vae.encode(im.to(self.torch_device) * 2 - 1)
-        latent = latent.latent_dist.sample() * vae_magic_number
+            latent = self.vae.encode(im * 2 - 1)
+        latent = latent.latent_dist.sample(generator=generator) * vae_magic_number
         return latent
 
     def latents2imgs(self, latents, vae_magic_number):
@@ -36,11 +42,11 @@ class ImageProcessor:
         return (list): A list of images.
         """
         # getting the latents from VAE (decoder layers)
-        latents = latents * 1 / vae_magic_number
+        latents = latents.to(self.vae.dtype) * 1 / vae_magic_number
         with torch.no_grad():
             imgs = self.vae.decode(latents).sample
-        # let's convert images to PIL, so we can display them.
-        imgs = (imgs / 2 + 0.5).clamp(0, 1)
+        # let's convert images to PIL, so we can display them. numpy has no bfloat16, so go back to float32 first
+        imgs = (imgs.float() / 2 + 0.5).clamp(0, 1)
         imgs = imgs.detach().cpu().permute(0, 2, 3, 1).numpy()
         imgs = (imgs * 255).round().astype("uint8")
         imgs = [Image.fromarray(im) for im in imgs]
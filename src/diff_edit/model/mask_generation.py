@@ -10,13 +10,17 @@ from diff_edit.model.constants import TORCH_SEED, IMG_RESIZE_DIM, VAE_CONST
 
 
 class MaskGenerator:
-    def __init__(self, unet, scheduler, tokenizer, text_encoder, image_processor, torch_device):
+    def __init__(self, unet, scheduler, tokenizer, text_encoder, image_processor, torch_device,
+                 embedding_provider=None):
         self.unet = unet
         self.scheduler = scheduler
         self.tokenizer = tokenizer
         self.text_encoder = text_encoder
         self.image_processor = image_processor
         self.torch_device = torch_device
+        # optional callable mapping a list of prompts to their embeddings, e.g. cached ones. Used instead of the text
+        # encoder
+        self.embedding_provider = embedding_provider
         self.rough_mask = None
         self.processed_mask = None
 
@@ -28,8 +32,21 @@ class MaskGenerator:
 
             prompt (str): The prompt to get the embedding for.
         """
+        return self.get_embeddings_for_prompts([prompt])
+
+    def get_embeddings_for_prompts(self, prompts):
+        """
+            This method gets the embeddings for a list of prompts, with a single forward pass of the text encoder.
+
+            prompts (list[str]): The prompts to get the embeddings for.
+
+            return (torch.Tensor): The embeddings, with shape (len(prompts), L, D).
+        """
+        if self.embedding_provider is not None:
+            return self.embedding_provider(prompts)
+
         max_length = self.tokenizer.model_max_length
-        tokens = self.tokenizer([prompt], padding="max_length", max_length=max_length, truncation=True,
+        tokens = self.tokenizer(prompts, padding="max_length", max_length=max_length, truncation=True,
                                 return_tensors="pt")
         with torch.no_grad():  # we are using for inference, no gradients needed
             return self.text_encoder(tokens.input_ids.to(self.torch_device))[0]
@@ -51,14 +68,14 @@ class MaskGenerator:
         diffs = []
         logging.debug(f"Running {n} times the diffusion process to calculate a 'noise distance' for each sample.")
         # So we can reproduce mask generation we generate a list of n seeds
-        torch.manual_seed(seed)
-        seeds = torch.randint(0, 2 ** 62, (n,)).tolist()
+        generator = torch.Generator().manual_seed(seed)
+        seeds = torch.randint(0, 2 ** 62, (n,), generator=generator).tolist()
+        # the two prompts and the unconditional one are encoded together, once for all the samples
+        emb1, emb2, uncond = self.get_embeddings_for_prompts([prompt1, prompt2, '']).split(1)
         for i in tqdm(range(n)):
             seed = seeds[i]  # Important to use same seed for the two noise samples
-            emb1 = self.get_embedding_for_prompt(prompt1)
-            _im1, n1 = self.predict_noise(emb1, encoded, seed)
-            emb2 = self.get_embedding_for_prompt(prompt2)
-            _im2, n2 = self.predict_noise(emb2, encoded, seed)
+            _im1, n1 = self.predict_noise(emb1, encoded, seed, uncond=uncond)
+            _im2, n2 = self.predict_noise(emb2, encoded, seed, uncond=uncond)
 
             # Aggregate the channel components by taking the Euclidean distance.
             diffs.append((n1 - n2)[0].pow(2).sum(dim=0).pow(0.5)[None])
@@ -125,7 +142,8 @@ class MaskGenerator:
     # Given a starting image latent and a prompt; predict the noise that should be removed to transform
     # the noised source image to a denoised image guided by the prompt.
     def predict_noise(self, text_embeddings: torch.Tensor, im_latents: torch.Tensor, seed: int = TORCH_SEED,
-                       guidance_scale: float = 7., strength: float = 0.5, num_inference_steps: int = 50):
+                       guidance_scale: float = 7., strength: float = 0.5, num_inference_steps: int = 50,
+                       uncond: torch.Tensor = None):
         """
         This method predicts the noise that should be removed to transform the noised source image to a denoised image
 
@@ -135,13 +153,15 @@ class MaskGenerator:
         guidance_scale (float): The scale to use for guidance.
         strength (float): The strength to use for the prediction.
         num_inference_steps (int): The number of inference steps to use for the prediction.
+        uncond (torch.Tensor): The embedding of the unconditional prompt. Optional, computed when not provided.
 
         return (tuple): A tuple containing the denoised image and the predicted noise.
         """
         # num_inference_steps is Number of denoising steps
-        torch.manual_seed(seed)  # initial latent noise
+        generator = torch.Generator(device=self.torch_device).manual_seed(seed)  # initial latent noise
 
-        uncond = self.get_embedding_for_prompt('')  # unconditional prompt
+        if uncond is None:
+            uncond = self.get_embedding_for_prompt('')  # unconditional prompt
         text_embeddings = torch.cat([uncond, text_embeddings])  # concatenate unconditional and conditional prompts
 
         # Prep Scheduler
@@ -154,9 +174,10 @@ class MaskGenerator:
         timesteps = self.scheduler.timesteps[-init_timestep]
         timesteps = torch.tensor([timesteps] * 1, device=self.torch_device).float()  # [timesteps] * 1 * 1
 
-        noise = torch.randn_like(im_latents)
+        # the latents may come in reduced precision, the scheduler math runs in float32, only the UNet inputs don't
+        im_latents = im_latents.to(self.torch_device).float()
+        noise = torch.randn(im_latents.shape, generator=generator, device=self.torch_device, dtype=torch.float32)
         latents = self.scheduler.add_noise(im_latents, noise, timesteps=timesteps)
-        latents = latents.to(self.torch_device).float()
 
         t_start = max(num_inference_steps - init_timestep + offset, 0)
         timesteps = self.scheduler.timesteps[t_start:].to(self.torch_device)
@@ -168,9 +189,10 @@ class MaskGenerator:
             latent_model_input = torch.cat([latents] * 2)
             latent_model_input = self.scheduler.scale_model_input(latent_model_input, tm)
 
-            # predict the noise residual
+            # predict the noise residual. The UNet may run in reduced precision, the scheduler math stays in float32
             with torch.no_grad():
-                noise_pred = self.unet(latent_model_input, tm, encoder_hidden_states=text_embeddings)["sample"]
+                noise_pred = self.unet(latent_model_input.to(self.unet.dtype), tm,
+                                       encoder_hidden_states=text_embeddings.to(self.unet.dtype))["sample"].float()
 
             noise_pred_uncond, noise_pred_text = noise_pred.chunk(2)
 
@@ -1,4 +1,5 @@
 import logging
+from functools import partial
 
 import torch
 
@@ -64,9 +65,11 @@ class ModelComposer:
         vae = AutoencoderKL.from_pretrained(self.vae_model)
         unet = UNet2DConditionModel.from_pretrained(self.unet, subfolder="unet")
 
-        inpainting = StableDiffusionInpaintPipeline.from_pretrained(self.inpainting)
+        # the inpainting pipeline is large and not needed to create masks, DiffEdit loads it on first use
+        inpainting_loader = partial(StableDiffusionInpaintPipeline.from_pretrained, self.inpainting)
 
-        return DiffEdit(tokenizer, text_encoder, vae, unet, inpainting, self.scheduler, self.torch_dev)
+        return DiffEdit(tokenizer, text_encoder, vae, unet, None, self.scheduler, self.torch_dev,
+                        inpainting_loader=inpainting_loader)
 
     def __str__(self):
         return f"ModelComposer(vae_model={self.vae_model}, tokenizer={self.tokenizer}, text_encoder=" \
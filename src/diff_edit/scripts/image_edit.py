@@ -176,6 +176,22 @@ def parse_args():
 
     return args
 
+def save_results(out, save_path):
+    """
+    Save the mask visualization and the inpainted image returned by demo_diffedit. The visualization is saved next
+    to the result as <save_path stem>_mask.png, so it doesn't overwrite the binary mask.png written by demo_diffedit.
+
+    out (list): The output of demo_diffedit: the original image, the blended mask and the inpainted image.
+    save_path (str): The path to save the inpainted image to.
+
+    return (str): The path the mask visualization was saved to.
+    """
+    mask_path = f"{os.path.splitext(save_path)[0]}_mask.png"
+    out[1].save(mask_path)  # blended mask
+    out[-1].save(save_path)  # inpainted image
+    return mask_path
+
+
 def diff_edit_main():
     args = parse_args()
 
@@ -227,12 +243,12 @@ def diff_edit_main():
     print(f"> Editing image {im_path}")
     if args.remove_prompt:
         print(f"> Removing prompt {args.remove_prompt}")
-        out = diff_edit.demo_diffedit(im_path, args.remove_prompt, args.add_prompt, n=args.num_samples, seed=42)
+        out = diff_edit.demo_diffedit(im_path, args.remove_prompt, args.add_prompt, n=args.num_samples, seed=args.seed)
         if len(out) > 1:
             print('Saving result to', args.save_path)
-            out[1].save(os.path.join(os.path.dirname(args.save_path), 'mask.png'))
-            out[-1].save(args.save_path)  # inpainted image
-        print(f"> Result saved to result.png")
+            mask_path = save_results(out, args.save_path)
+            print(f"> Mask visualization saved to {mask_path}")
+        print(f"> Result saved to {args.save_path}")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,319 @@
+import os
+
+import pytest
+import torch
+from PIL import Image
+
+from diff_edit.model.aot_compilation import model_identity, to_package_layout
+from diff_edit.model.constants import IMG_RESIZE_DIM
+from diff_edit.model.diff_edit_model import DiffEdit, _load_resized
+
+
+class FakeTokenizer:
+    model_max_length = 8
+
+    def __call__(self, prompts, padding, max_length, truncation, return_tensors):
+        class Tokens:
+            input_ids = torch.zeros(len(prompts), max_length, dtype=torch.long)
+        return Tokens()
+
+
+class FakeTextEncoder:
+    def __init__(self):
+        self.batch_sizes = []
+
+    def __call__(self, input_ids):
+        self.batch_sizes.append(input_ids.shape[0])
+        return (torch.randn(input_ids.shape[0], input_ids.shape[1], 4),)
+
+
+@pytest.fixture
+def diff_edit_model():
+    # DiffEdit without the model weights, only the attributes needed by the helpers under test
+    model = DiffEdit.__new__(DiffEdit)
+    model.torch_device = "cpu"
+    model.dtype = torch.float32
+    model.low_vram = False
+    model._text_encoder_quantized = False
+    model._emb_cache = {}
+    model.tokenizer = FakeTokenizer()
+    model.text_encoder = FakeTextEncoder()
+    return model
+
+
+@pytest.mark.parametrize("missing", [None, "mask.png", "rough_mask.png", "blended_mask.png"])
+def test_load_mask_missing_files(diff_edit_model, tmp_path, missing):
+    workdir = tmp_path / "masks"
+    if missing is not None:
+        workdir.mkdir()
+        for name in {"mask.png", "rough_mask.png", "blended_mask.png"} - {missing}:
+            Image.new("L", (8, 8)).save(workdir / name)
+
+    with pytest.raises(ValueError):
+        diff_edit_model.load_mask(workdir=str(workdir))
+
+
+def test_embeddings_are_cached(diff_edit_model):
+    first = diff_edit_model._get_embedding_for_prompt("a cat")
+    second = diff_edit_model._get_embedding_for_prompt("a cat")
+    assert first.shape == (1, FakeTokenizer.model_max_length, 4)
+    assert torch.equal(first, second)
+    assert diff_edit_model.text_encoder.batch_sizes == [1], "A cached prompt should not be encoded again"
+
+    diff_edit_model._get_embedding_for_prompt("a dog")
+    assert diff_edit_model.text_encoder.batch_sizes == [1, 1]
+
+
+def test_embeddings_are_encoded_once(diff_edit_model):
+    embeddings = diff_edit_model._get_embeddings_for_prompts(["a cat", "a dog", "a cat", ""])
+    assert embeddings.shape == (4, FakeTokenizer.model_max_length, 4)
+    assert diff_edit_model.text_encoder.batch_sizes == [3], "Unique prompts should be encoded in a single batch"
+    assert torch.equal(embeddings[0], embeddings[2])
+
+    embeddings = diff_edit_model._get_embeddings_for_prompts(["a dog", ""])
+    assert diff_edit_model.text_encoder.batch_sizes == [3], "Cached prompts should not be encoded again"
+    assert embeddings.shape == (2, FakeTokenizer.model_max_length, 4)
+
+    diff_edit_model._get_embedding_for_prompt("a bird")
+    assert diff_edit_model.text_encoder.batch_sizes == [3, 1]
+
+@pytest.mark.parametrize("save", [True, False])
+def test_demo_diffedit_save(diff_edit_model, tmp_path, monkeypatch, save):
+    monkeypatch.chdir(tmp_path)
+    image = Image.new("RGB", (IMG_RESIZE_DIM, IMG_RESIZE_DIM), (200, 100, 0))
+    mask = Image.new("L", (IMG_RESIZE_DIM, IMG_RESIZE_DIM), 255)
+    inpainted = Image.new("RGB", (IMG_RESIZE_DIM, IMG_RESIZE_DIM), (0, 100, 200))
+    monkeypatch.setattr(diff_edit_model, "_warmup", lambda: None, raising=False)
+    monkeypatch.setattr(diff_edit_model, "create_mask", lambda *args, **kwargs: (mask, mask, image), raising=False)
+    monkeypatch.setattr(diff_edit_model, "inpaint_mask_with_prompt", lambda *args, **kwargs: inpainted,
+                        raising=False)
+
+    out = diff_edit_model.demo_diffedit(image, "a cat", "a dog", n=1, save=save)
+
+    assert out == [image, image, inpainted]
+    if save:
+        assert {"mask.png", "rough_mask.png", "blended_mask.png", "original_image.png",
+                "inpainted_image.png"}.issubset(os.listdir(tmp_path))
+    else:
+        assert os.listdir(tmp_path) == [], "Nothing should be written to disk with save=False"
+
+
+def test_save_and_load_mask(diff_edit_model, tmp_path):
+    mask = Image.new("L", (IMG_RESIZE_DIM, IMG_RESIZE_DIM), 0)
+    mask.paste(255, (0, 0, IMG_RESIZE_DIM // 2, IMG_RESIZE_DIM))
+    rough_mask = Image.new("L", (64, 64), 128)
+    blended_mask = Image.new("RGB", (IMG_RESIZE_DIM, IMG_RESIZE_DIM), (10, 20, 30))
+    image = Image.new("RGB", (IMG_RESIZE_DIM, IMG_RESIZE_DIM), (200, 100, 0))
+
+    diff_edit_model.save_mask(mask, rough_mask, blended_mask, image, workdir=str(tmp_path))
+    assert {"mask.png", "rough_mask.png", "blended_mask.png", "original_image.png"}.issubset(os.listdir(tmp_path))
+
+    loaded_mask, loaded_rough_mask, loaded_blended_mask = diff_edit_model.load_mask(workdir=str(tmp_path))
+    assert loaded_mask.mode == "1", "The binary mask should be stored with 1 bit per pixel"
+    assert list(loaded_mask.convert("L").getdata()) == list(mask.getdata())
+    assert list(loaded_rough_mask.getdata()) == list(rough_mask.getdata())
+    assert list(loaded_blended_mask.getdata()) == list(blended_mask.getdata())
+
+
+def test_save_by_path(diff_edit_model, tmp_path):
+    im_path = str(tmp_path / "input.png")
+    Image.new("RGB", (100, 50), (200, 100, 0)).save(im_path)
+    mask = Image.new("L", (IMG_RESIZE_DIM, IMG_RESIZE_DIM), 255)
+    workdir = tmp_path / "out"
+    workdir.mkdir()
+
+    diff_edit_model.save_mask(mask, mask, mask.convert("RGB"), im_path, workdir=str(workdir))
+    diff_edit_model.save_inpainted_image(Image.new("RGB", (IMG_RESIZE_DIM, IMG_RESIZE_DIM)), workdir=str(workdir))
+
+    with Image.open(workdir / "original_image.png") as original_image:
+        assert original_image.size == (IMG_RESIZE_DIM, IMG_RESIZE_DIM)
+        assert original_image.getpixel((0, 0)) == (200, 100, 0)
+    assert os.path.exists(workdir / "inpainted_image.png")
+
+    loaded = diff_edit_model.load_mask(workdir=str(workdir))
+    for name in ("mask.png", "rough_mask.png", "blended_mask.png"):
+        os.remove(workdir / name)
+    # the loaded masks are copies, detached from the files
+    assert [im.size for im in loaded] == [(IMG_RESIZE_DIM, IMG_RESIZE_DIM)] * 3
+
+def test_load_resized_reloads_on_mtime_change(diff_edit_model, tmp_path):
+    _load_resized.cache_clear()
+    path = str(tmp_path / "image.png")
+    Image.new("RGB", (100, 50), (255, 0, 0)).save(path)
+
+    im = diff_edit_model._load_image(path)
+    assert im.size == (IMG_RESIZE_DIM, IMG_RESIZE_DIM)
+    assert im.getpixel((0, 0)) == (255, 0, 0)
+    diff_edit_model._load_image(path)
+    assert _load_resized.cache_info().hits == 1, "An unchanged file should come from the cache"
+
+    # callers get copies, editing one doesn't change the cached image
+    im.paste((0, 255, 0), (0, 0, 1, 1))
+    assert diff_edit_model._load_image(path).getpixel((0, 0)) == (255, 0, 0)
+
+    Image.new("RGB", (100, 50), (0, 0, 255)).save(path)
+    mtime = os.path.getmtime(path) + 10
+    os.utime(path, (mtime, mtime))
+    assert diff_edit_model._load_image(path).getpixel((0, 0)) == (0, 0, 255)
+
+def test_cli_results_keep_the_saved_mask(diff_edit_model, tmp_path, monkeypatch):
+    from diff_edit.scripts.image_edit import save_results
+
+    monkeypatch.chdir(tmp_path)
+    image = Image.new("RGB", (IMG_RESIZE_DIM, IMG_RESIZE_DIM), (200, 100, 0))
+    mask = Image.new("L", (IMG_RESIZE_DIM, IMG_RESIZE_DIM), 0)
+    mask.paste(255, (0, 0, IMG_RESIZE_DIM // 2, IMG_RESIZE_DIM))
+    blended_mask = Image.blend(image, mask.convert("RGB"), 0.4)
+    inpainted = Image.new("RGB", (IMG_RESIZE_DIM, IMG_RESIZE_DIM), (0, 100, 200))
+
+    # what demo_diffedit(save=True) writes, then what the CLI writes with the default --save-path
+    diff_edit_model.save_mask(mask, mask, blended_mask, image)
+    mask_path = save_results([image, blended_mask, inpainted], "./result.png")
+
+    assert os.path.abspath(mask_path) != os.path.abspath("mask.png")
+    assert os.path.exists("result.png") and os.path.exists(mask_path)
+    loaded_mask, _, _ = diff_edit_model.load_mask("./")
+    assert loaded_mask.mode == "1", "The CLI visualization should not overwrite the binary mask"
+    assert list(loaded_mask.convert("L").getdata()) == list(mask.getdata())
+
+
+class FakeOffloadedTextEncoder(FakeTextEncoder):
+    def __init__(self, fail=False):
+        super().__init__()
+        self.fail = fail
+        self.devices = []
+
+    def to(self, device):
+        self.devices.append(device)
+        return self
+
+    def __call__(self, input_ids):
+        if self.fail:
+            raise RuntimeError("forward failed")
+        return super().__call__(input_ids)
+
+
+@pytest.mark.parametrize("fail", [False, True])
+def test_low_vram_offloads_text_encoder(diff_edit_model, fail):
+    diff_edit_model.low_vram = True
+    diff_edit_model.torch_device = "meta"  # any device other than the CPU the encoder is offloaded to
+    diff_edit_model.text_encoder = FakeOffloadedTextEncoder(fail=fail)
+
+    if fail:
+        with pytest.raises(RuntimeError):
+            diff_edit_model._get_embedding_for_prompt("a cat")
+    else:
+        diff_edit_model._get_embedding_for_prompt("a cat")
+    assert diff_edit_model.text_encoder.devices == ["meta", "cpu"], \
+        "The text encoder should go to the device for the forward and back to the CPU, even on failure"
+
+    if not fail:
+        # cached prompts don't need the encoder at all
+        diff_edit_model._get_embedding_for_prompt("a cat")
+        assert diff_edit_model.text_encoder.devices == ["meta", "cpu"]
+
+
+class FakeImageProcessor:
+    def __init__(self):
+        self.encoded = 0
+        self.decoded = 0
+
+    def img2latent(self, im, vae_magic_number, generator=None):
+        self.encoded += 1
+        return torch.randn(1, 4, 8, 8, generator=generator)
+
+    def latents2imgs(self, latents, vae_magic_number):
+        self.decoded += 1
+        return [Image.new("RGB", (IMG_RESIZE_DIM, IMG_RESIZE_DIM))]
+
+
+def test_load_and_encode_memo(diff_edit_model, tmp_path):
+    diff_edit_model.image_processor = FakeImageProcessor()
+    diff_edit_model._last_encoded = None
+    path = str(tmp_path / "image.png")
+    Image.new("RGB", (100, 50), (255, 0, 0)).save(path)
+
+    im, latent = diff_edit_model._load_and_encode(path, seed=1)
+    assert im.size == (IMG_RESIZE_DIM, IMG_RESIZE_DIM)
+    assert latent.is_contiguous(memory_format=torch.channels_last)
+    assert diff_edit_model.image_processor.encoded == 1
+
+    memo_im, memo_latent = diff_edit_model._load_and_encode(path, seed=1)
+    assert diff_edit_model.image_processor.encoded == 1, "Same path, mtime and seed should hit the memo"
+    assert memo_im is im and torch.equal(memo_latent, latent)
+    assert memo_latent.is_contiguous(memory_format=torch.channels_last)
+
+    diff_edit_model._load_and_encode(path, seed=2)
+    assert diff_edit_model.image_processor.encoded == 2, "Another seed should encode again"
+
+    mtime = os.path.getmtime(path) + 10
+    os.utime(path, (mtime, mtime))
+    diff_edit_model._load_and_encode(path, seed=2)
+    assert diff_edit_model.image_processor.encoded == 3, "A modified file should encode again"
+
+
+def test_load_and_encode_image_and_tensor(diff_edit_model):
+    diff_edit_model.image_processor = FakeImageProcessor()
+    diff_edit_model._last_encoded = None
+
+    image = Image.new("RGB", (100, 50), (255, 0, 0))
+    im, latent = diff_edit_model._load_and_encode(image)
+    assert im.size == (IMG_RESIZE_DIM, IMG_RESIZE_DIM)
+    assert latent.is_contiguous(memory_format=torch.channels_last)
+    diff_edit_model._load_and_encode(image)
+    assert diff_edit_model.image_processor.encoded == 2, "In-memory images are not memoised"
+
+    given_latent = torch.randn(1, 4, 8, 8)
+    im, latent = diff_edit_model._load_and_encode(given_latent)
+    assert diff_edit_model.image_processor.encoded == 2, "A latent should not be encoded again"
+    assert diff_edit_model.image_processor.decoded == 1, "A latent should be decoded to get the image"
+    assert im.size == (IMG_RESIZE_DIM, IMG_RESIZE_DIM)
+    assert torch.equal(latent, given_latent)
+    assert latent.is_contiguous(memory_format=torch.channels_last)
+
+
+class FakeConfigModule(torch.nn.Module):
+    def __init__(self, **config):
+        super().__init__()
+        self.config = config
+
+
+def test_aot_package_identity_and_layout():
+    unet = FakeConfigModule(_name_or_path="CompVis/stable-diffusion-v1-4", sample_size=64)
+    identity = model_identity(unet)
+    assert identity.startswith("CompVis_stable-diffusion-v1-4-")
+    assert "/" not in identity
+    assert identity == model_identity(FakeConfigModule(_name_or_path="CompVis/stable-diffusion-v1-4", sample_size=64))
+    assert identity != model_identity(FakeConfigModule(_name_or_path="CompVis/stable-diffusion-v1-4", sample_size=96))
+    assert identity != model_identity(FakeConfigModule(_name_or_path="other/model", sample_size=64))
+
+    latents = torch.zeros(2, 4, 8, 8).contiguous(memory_format=torch.channels_last)
+    assert to_package_layout(latents) is latents, "channels_last inputs should not be copied"
+    assert to_package_layout(torch.zeros(2, 4, 8, 8)).is_contiguous(memory_format=torch.channels_last)
+    assert to_package_layout(torch.zeros(8, 4).t()).is_contiguous()
+    assert to_package_layout(1) == 1
+
+
+def test_inpainting_is_loaded_lazily(diff_edit_model, monkeypatch):
+    prepared = []
+    monkeypatch.setattr(DiffEdit, "_prepare_inpainting",
+                        lambda self, device: prepared.append((device, torch.is_inference_mode_enabled())))
+    calls = []
+    pipeline = object()
+
+    def loader():
+        calls.append(torch.is_inference_mode_enabled())
+        return pipeline
+
+    diff_edit_model._inpainting = None
+    diff_edit_model._inpainting_loader = loader
+    diff_edit_model._inpainter = None
+    assert calls == [], "The inpainting pipeline should not be loaded before it's needed"
+
+    # the first access happens inside the inference mode methods, the weights must still be loaded outside of it
+    with torch.inference_mode():
+        assert diff_edit_model.inpainting is pipeline
+    assert diff_edit_model.inpainter.inpainting is pipeline
+    assert diff_edit_model.inpainting is pipeline
+    assert calls == [False], "The inpainting pipeline should be loaded only once, outside inference mode"
+    assert prepared == [("cpu", False)]